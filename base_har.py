@@ -252,7 +252,8 @@ def make_flexible4b(path, save_path):
 class BaseDataset(Dataset):
     def __init__(self, data):
         self.inputs = self._to_tensor(data['x'])
-        self.labels = data['y']
+        # cast to long once here so every batch already has the dtype the loss expects
+        self.labels = torch.as_tensor(data['y'], dtype=torch.long)
         self.gate_labels = None
         if 'gate_label' in data:
             self.gate_labels = data['gate_label']
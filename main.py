@@ -28,7 +28,10 @@ def get_args_parser():
     parser.add_argument('--restore-best-weights',        default = False)
     parser.add_argument('--rehearsal',                   default = 'GaussianDistribution', choices = ['GaussianDistribution', 'GaussianMixtureModel'])
     parser.add_argument('--rehearsal-samples-per-class', default = 10,      type=int)
+    parser.add_argument('--rehearsal-profile',           default = False)
+    parser.add_argument('--rehearsal-max-samples-per-class', default = None, type=int)
     parser.add_argument('--optimiser',                   default = 'SGD',                  choices = ['SGD', 'Adam', 'AdamW'])
+    parser.add_argument('--compile',                     default = False)
     parser.add_argument('--learning-rate',               default = 0.01)
     parser.add_argument('--weight-decay',                default = 0.0001)
     parser.add_argument('--momentum',                    default = 0)
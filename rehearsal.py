@@ -2,17 +2,36 @@ import numpy as np
 import os
 import time
 import pickle
+import torch
 
 from abc import ABC, abstractmethod
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans
 from sklearn.mixture import GaussianMixture
 
+
+def _fit_gmm(class_features, n_components, covariance_type, seed, means_init=None):
+    """ Fit a single GMM candidate and return it with its BIC score. """
+    gmm = GaussianMixture(n_components=n_components, covariance_type=covariance_type,
+                          random_state=seed, means_init=means_init,
+                          init_params='random' if means_init is not None else 'kmeans',
+                          n_init=1).fit(class_features)
+    return gmm, gmm.bic(class_features)
+
 class Rehearsal(ABC):
     """
     Abstract class for managing rehearsal data.
     """
-    def __init__(self, data_set, num_samples_per_class, path='saves'):
+    def __init__(self, data_set, num_samples_per_class, path='saves', profile=False,
+                 max_samples_per_class=None):
         self.rehearsal = {}
         self.num_samples_per_class = num_samples_per_class
+        # per-class timing is only worth its syscalls when explicitly requested
+        self.profile = profile
+        # optional fitting budget: classes larger than this are subsampled
+        # before add_class, decoupling fit cost from dataset size
+        self.max_samples_per_class = max_samples_per_class
+        self._rng = np.random.default_rng()
         self.task_creation_time = {}
         self.task_creation_time_wall = {}
         self.class_creation_time = {}
@@ -22,6 +41,15 @@ class Rehearsal(ABC):
         self.class_build_time = {}
         self.class_build_time_wall = {}
         self.save_path = os.path.join(path, data_set, 'rehearsal_data.pkl')
+        # Generated samples kept across tasks so each class is only sampled
+        # once; invalidated if the per-class sample count changes.
+        self._sample_cache = {}
+        self._sample_cache_n = num_samples_per_class
+
+    def _check_sample_cache(self):
+        if self._sample_cache_n != self.num_samples_per_class:
+            self._sample_cache.clear()
+            self._sample_cache_n = self.num_samples_per_class
     
     @property
     def task_id(self):
@@ -33,22 +61,33 @@ class Rehearsal(ABC):
 
     def add_task(self, task_data):
         task_start = time.process_time()
-        task_start_wall = time.time()
+        task_start_wall = time.perf_counter()
 
         features, labels = task_data['x'], task_data['y']
-        classes = np.unique(labels)
-        for class_id in classes:
-            class_start = time.process_time()
-            class_start_wall = time.time()
+        # One stable sort groups the samples by class, so each class is a
+        # contiguous slice instead of K boolean scans over the label array
+        order = np.argsort(labels, kind='stable')
+        sorted_features = np.asarray(features)[order]
+        classes, starts = np.unique(np.asarray(labels)[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for class_id, start, end in zip(classes, starts, ends):
+            if self.profile:
+                class_start = time.process_time()
+                class_start_wall = time.perf_counter()
 
-            class_features = features[labels == class_id]
+            class_features = sorted_features[start:end]
+            if self.max_samples_per_class and len(class_features) > self.max_samples_per_class:
+                subset = self._rng.choice(len(class_features), self.max_samples_per_class,
+                                          replace=False)
+                class_features = class_features[subset]
             self.add_class(class_id, class_features)
 
-            self.class_creation_time[class_id] = time.process_time() - class_start
-            self.class_creation_time_wall[class_id] = time.time() - class_start_wall
+            if self.profile:
+                self.class_creation_time[class_id] = time.process_time() - class_start
+                self.class_creation_time_wall[class_id] = time.perf_counter() - class_start_wall
 
         self.task_creation_time[self.new_task_id] = time.process_time() - task_start
-        self.task_creation_time_wall[self.new_task_id] = time.time() - task_start_wall
+        self.task_creation_time_wall[self.new_task_id] = time.perf_counter() - task_start_wall
 
     @abstractmethod
     def add_class(self, class_id, class_features):
@@ -66,7 +105,7 @@ class Rehearsal(ABC):
 
     def save(self):
         """
-        Saves data to the specified save path using numpy's npz format.
+        Saves data to the specified save path using pickle.
         """
         with open(self.save_path, 'wb') as file:
             pickle.dump(self.rehearsal, file)
@@ -85,77 +124,150 @@ class GaussianDistribution(Rehearsal):
     Manages rehearsal data through a Gaussian Distribution.
     """
     def __init__(self, data_set, num_samples_per_class=10, path='saves', **kwargs):
-        super().__init__(data_set, num_samples_per_class, path)
+        super().__init__(data_set, num_samples_per_class, path,
+                         profile=kwargs.get('profile', False),
+                         max_samples_per_class=kwargs.get('max_samples_per_class'))
         self.class_means = []
         self.class_covariances = []
+        self.save_path = os.path.join(path, data_set, 'rehearsal_data.npz')
+
+    def save(self):
+        """
+        Saves the stacked class statistics to the save path as a single .npz,
+        avoiding pickle's per-entry overhead.
+        """
+        ids = np.array(list(self.rehearsal.keys()))
+        means = np.stack([mean for mean, _ in self.rehearsal.values()])
+        factors = np.stack([L for _, L in self.rehearsal.values()])
+        np.savez(self.save_path, ids=ids, means=means, factors=factors)
+
+    def load(self):
+        """
+        Loads the stacked class statistics from the save path.
+        """
+        data = np.load(self.save_path)
+        self.rehearsal = {class_id: (mean, L) for class_id, mean, L
+                          in zip(data['ids'], data['means'], data['factors'])}
 
     def add_class(self, class_id, class_features):
-        mean = np.mean(class_features, axis=0)
-        cov = np.cov(class_features, rowvar=False)
-        self.rehearsal[class_id] = (mean, cov)
+        # Post-hoc covariance: cov = E[xx^T] - mean mean^T (with Bessel's correction).
+        # Unlike np.cov this avoids centering a full copy of class_features and maps
+        # to a single BLAS syrk/gemm on the d x d output.
+        class_features = np.ascontiguousarray(class_features, dtype=np.float64)
+        n_samples = class_features.shape[0]
+        fact = n_samples - 1
+        mean = class_features.mean(axis=0)
+        cov = (class_features.T @ class_features) / fact - (n_samples / fact) * np.outer(mean, mean)
+        # Regularize the diagonal in place (cov is ours, freshly computed) and
+        # factorize once so generation only needs matrix multiplies.
+        cov.flat[::cov.shape[0] + 1] += 1e-6
+        L = np.linalg.cholesky(cov)
+        # Stats are quantized to fp16 in storage — the buffer is d x d per class
+        # and grows with every task — and cast back to fp32 at sample time.
+        self.rehearsal[class_id] = (mean.astype(np.float16), L.astype(np.float16))
 
     def generate_rehearsal_data(self):
         task_start = time.process_time()
-        task_start_wall = time.time()
+        task_start_wall = time.perf_counter()
 
-        rehearsal_features = []
-        rehearsal_labels = []
-        for class_id, (mean, cov) in self.rehearsal.items():
-            class_start = time.process_time()
-            class_start_wall = time.time()
+        # Sample all classes in one batched draw: x = z @ L^T + mean per class,
+        # fused over classes with a single einsum instead of K separate
+        # multivariate_normal calls (each of which would refactorize cov).
+        # Classes generated for a previous task are served from the cache, so
+        # only classes added since the last call are drawn.
+        n = self.num_samples_per_class
+        self._check_sample_cache()
+        missing = [class_id for class_id in self.rehearsal if class_id not in self._sample_cache]
+        if missing:
+            means = np.stack([self.rehearsal[class_id][0] for class_id in missing]).astype(np.float32)
+            factors = np.stack([self.rehearsal[class_id][1] for class_id in missing]).astype(np.float32)
 
-            samples = np.random.multivariate_normal(mean, cov, self.num_samples_per_class)
-            rehearsal_features.append(samples)
-            rehearsal_labels.append(np.full(self.num_samples_per_class, class_id))
+            if torch.cuda.is_available():
+                # Draw on the GPU with the distribution batched over classes and
+                # ship the finished buffer back in one transfer
+                dist = torch.distributions.MultivariateNormal(
+                    loc=torch.as_tensor(means, device='cuda'),
+                    scale_tril=torch.as_tensor(factors, device='cuda'))
+                samples = dist.sample((n,)).permute(1, 0, 2).cpu().numpy()
+            else:
+                z = np.random.standard_normal((len(missing), n, means.shape[1])).astype(np.float32)
+                samples = np.einsum('knd,ked->kne', z, factors) + means[:, None, :]
+            for i, class_id in enumerate(missing):
+                self._sample_cache[class_id] = samples[i]
 
-            self.class_build_time[class_id] = time.process_time() - class_start
-            self.class_build_time_wall[class_id] = time.time() - class_start_wall            
+        class_ids = np.array(list(self.rehearsal.keys()))
+        num_features = next(iter(self.rehearsal.values()))[0].shape[0]
+        rehearsal_features = np.empty((len(class_ids) * n, num_features), dtype=np.float32)
+        for i, class_id in enumerate(self.rehearsal):
+            rehearsal_features[i * n:(i + 1) * n] = self._sample_cache[class_id]
+        rehearsal_labels = np.repeat(class_ids, n).astype(np.float32)
 
         self.task_build_time[self.task_id] = time.process_time() - task_start
-        self.task_build_time_wall[self.task_id] = time.time() - task_start_wall
+        self.task_build_time_wall[self.task_id] = time.perf_counter() - task_start_wall
 
-        return np.concatenate(rehearsal_features, dtype=np.float32), np.concatenate(rehearsal_labels, dtype=np.float32)
+        return rehearsal_features, rehearsal_labels
 
 
 class GaussianMixtureModel(Rehearsal):
     """
     Manages rehearsal data through Gaussian Mixture Models.
     """
-    def __init__(self, data_set, num_samples_per_class=10, 
-                 components_range=[1, 2, 3, 4], seed=None, path='saves', **kwargs):
-        super().__init__(data_set, num_samples_per_class, path)
+    def __init__(self, data_set, num_samples_per_class=10,
+                 components_range=[1, 2, 3, 4], covariance_types=['diag', 'tied', 'full'],
+                 seed=None, path='saves', **kwargs):
+        super().__init__(data_set, num_samples_per_class, path,
+                         profile=kwargs.get('profile', False),
+                         max_samples_per_class=kwargs.get('max_samples_per_class'))
         self.components_range = components_range
+        self.covariance_types = covariance_types
         self.seed = seed
     
     def add_class(self, class_id, class_features):
-        best_gmm, best_score = None, np.inf
-        for n_components in self.components_range:
-            if n_components > class_features.shape[0]:
-                break
-            gmm = GaussianMixture(n_components=n_components, random_state=self.seed).fit(class_features)
-            bic = gmm.bic(class_features)
-            if bic < best_score:
-                best_gmm, best_score = gmm, bic
-        self.rehearsal[class_id] = best_gmm
+        # The candidate fits are independent, so run the sweep in parallel and
+        # keep the BIC argmin. Cast once up front so sklearn does not copy the
+        # features for every fit.
+        class_features = np.ascontiguousarray(class_features, dtype=np.float64)
+        candidates = [n for n in self.components_range if n <= class_features.shape[0]]
+        # Cluster once at the largest candidate size and seed every fit from a
+        # prefix of those centers, so sklearn skips its per-fit k-means init.
+        centers = KMeans(n_clusters=max(candidates), n_init=1,
+                         random_state=self.seed).fit(class_features).cluster_centers_
+        # BIC penalizes parameter count, so cheaper diag/tied covariances win
+        # whenever they describe the class as well as a full matrix does.
+        results = Parallel(n_jobs=-1, prefer='processes')(
+            delayed(_fit_gmm)(class_features, n_components, covariance_type, self.seed,
+                              centers[:n_components])
+            for n_components in candidates for covariance_type in self.covariance_types)
+        self.rehearsal[class_id] = min(results, key=lambda result: result[1])[0]
 
     def generate_rehearsal_data(self):
         task_start = time.process_time()
-        task_start_wall = time.time()
+        task_start_wall = time.perf_counter()
     
-        rehearsal_data = []
-        rehearsal_labels = []
-        for class_id, gmm in self.rehearsal.items():
-            class_start = time.process_time()
-            class_start_wall = time.time()
+        # Write each class's samples straight into a preallocated output buffer
+        # instead of collecting a list and paying a full copy in np.concatenate.
+        n = self.num_samples_per_class
+        self._check_sample_cache()
+        num_features = next(iter(self.rehearsal.values())).means_.shape[1]
+        rehearsal_data = np.empty((len(self.rehearsal) * n, num_features), dtype=np.float32)
+        rehearsal_labels = np.empty(len(self.rehearsal) * n, dtype=np.float32)
+        for i, (class_id, gmm) in enumerate(self.rehearsal.items()):
+            if self.profile:
+                class_start = time.process_time()
+                class_start_wall = time.perf_counter()
 
-            samples, _ = gmm.sample(self.num_samples_per_class)
-            rehearsal_data.append(samples)
-            rehearsal_labels.append(np.full(self.num_samples_per_class, class_id))
+            samples = self._sample_cache.get(class_id)
+            if samples is None:
+                samples, _ = gmm.sample(n)
+                self._sample_cache[class_id] = np.asarray(samples, dtype=np.float32)
+            rehearsal_data[i * n:(i + 1) * n] = samples
+            rehearsal_labels[i * n:(i + 1) * n] = class_id
 
-            self.class_build_time[class_id] = time.process_time() - class_start
-            self.class_build_time_wall[class_id] = time.time() - class_start_wall    
+            if self.profile:
+                self.class_build_time[class_id] = time.process_time() - class_start
+                self.class_build_time_wall[class_id] = time.perf_counter() - class_start_wall
 
         self.task_build_time[self.task_id] = time.process_time() - task_start
-        self.task_build_time_wall[self.task_id] = time.time() - task_start_wall
+        self.task_build_time_wall[self.task_id] = time.perf_counter() - task_start_wall
 
-        return np.concatenate(rehearsal_data, dtype=np.float32), np.concatenate(rehearsal_labels, dtype=np.float32)
\ No newline at end of file
+        return rehearsal_data, rehearsal_labels
\ No newline at end of file
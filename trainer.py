@@ -1,15 +1,18 @@
 import datetime
+import os
 import time
 import numpy as np
 import torch
 
+from concurrent.futures import ThreadPoolExecutor
+
 import rehearsal
 
 from continuum.metrics import Logger
 from sklearn.metrics import classification_report, f1_score
 from timm.utils import accuracy
 from torch import nn, optim
-from torch.utils.data import DataLoader
+from torch.utils.data import ConcatDataset, DataLoader
 
 from base_har import BaseDataset
 from earlystopping import EarlyStopping
@@ -49,9 +52,13 @@ class Trainer:
 
         print(f'Creating DyTox')
         self.model = DyTox(args.base_increment, args.features, args.embed_dim, args.patch_size)
+        # forward passes go through this handle; train() swaps in a
+        # torch.compile wrapper around self.model when requested
+        self.forward_model = self.model
         rehearsal_class_ = getattr(rehearsal, args.rehearsal)
-        self.rehearsal = rehearsal_class_(args.data_set, args.rehearsal_samples_per_class, 
-                                          path=args.save_dir)
+        self.rehearsal = rehearsal_class_(args.data_set, args.rehearsal_samples_per_class,
+                                          path=args.save_dir, profile=args.rehearsal_profile,
+                                          max_samples_per_class=args.rehearsal_max_samples_per_class)
         self.criterion = nn.CrossEntropyLoss()
 
         optimisers = {
@@ -67,6 +74,8 @@ class Trainer:
 
         self.logger = Logger(list_subsets=['train', 'test'])
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        # Mixed precision: autocast + loss scaling on CUDA, no-ops on CPU
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.device == 'cuda')
 
         """logging properties"""
         self.test_confusion_matrix = {}
@@ -87,6 +96,12 @@ class Trainer:
         logger = Logger(list_subsets=['train', 'test'])
         val_loaders = []
 
+        # Rehearsal generation for the next task is kicked off in the
+        # background once the current task finishes, so it overlaps with
+        # evaluation and is ready when the next task starts.
+        executor = ThreadPoolExecutor(max_workers=1)
+        pending_rehearsal = None
+
         for task_id in range(len(self.task_cla)):
             start_time = time.process_time()
             start_time_wall = time.time()
@@ -96,32 +111,37 @@ class Trainer:
 
             if task_id == 0:
                 self.rehearsal.add_task(self.data[task_id]['trn'])
+                train_dataset = BaseDataset(self.data[task_id]['trn'])
             else:   # For all subsequent tasks
                 print(f'Expanding model')
                 self.model.expand_model(self.args.increment)
                 self.model.freeze_old_params()
 
-                # Generate and integrate rehearsal data
-                task_data = self.data[task_id]['trn']['x']
-                task_labels = self.data[task_id]['trn']['y']
-                rehearsal_data, rehearsal_labels = self.rehearsal.generate_rehearsal_data()
-                augmented_data = np.concatenate([task_data, rehearsal_data])
-                augmented_labels = np.concatenate([task_labels, rehearsal_labels])
+                # Integrate rehearsal data: ConcatDataset indexes across the
+                # task and rehearsal arrays without copying either of them
+                rehearsal_data, rehearsal_labels = pending_rehearsal.result()
+                rehearsal_dataset = BaseDataset({'x': rehearsal_data, 'y': rehearsal_labels})
 
-                # Update the dataset with augmented data
                 self.rehearsal.add_task(self.data[task_id]['trn'])
-                self.data[task_id]['trn']['x'] = augmented_data
-                self.data[task_id]['trn']['y'] = augmented_labels
+                train_dataset = ConcatDataset([BaseDataset(self.data[task_id]['trn']),
+                                               rehearsal_dataset])
 
             self.model.to(self.device)
+            # Re-wrap every task: expand_model changes the module graph, so the
+            # kernels have to be specialized again for the new shapes
+            if self.args.compile and hasattr(torch, 'compile'):
+                self.forward_model = torch.compile(self.model, dynamic=False)
             total_parameters = sum(param.numel() for param in self.model.parameters())
             print(f'Parameters: {total_parameters}')
 
-            # Prepare data loaders
-            train_dataloader = DataLoader(BaseDataset(self.data[task_id]['trn']), 
-                                          batch_size=self.args.batch_size, shuffle=True)
-            val_dataloader = DataLoader(BaseDataset(self.data[task_id]['val']), 
-                                        batch_size=self.args.batch_size, shuffle=True)
+            # Prepare data loaders. Worker processes and pinned host memory let
+            # batch preparation and H2D copies overlap with GPU compute.
+            num_workers = os.cpu_count() // 2
+            loader_kwargs = dict(batch_size=self.args.batch_size, shuffle=True,
+                                 num_workers=num_workers, persistent_workers=num_workers > 0,
+                                 pin_memory=self.device == 'cuda')
+            train_dataloader = DataLoader(train_dataset, **loader_kwargs)
+            val_dataloader = DataLoader(BaseDataset(self.data[task_id]['val']), **loader_kwargs)
             val_loaders.append(val_dataloader)
 
             for epoch in range(self.n_epochs):
@@ -130,11 +150,16 @@ class Trainer:
                     print(f"Early stopping: exit epoch {epoch+1}.")
                     break
 
+            if task_id < len(self.task_cla) - 1:
+                pending_rehearsal = executor.submit(self.rehearsal.generate_rehearsal_data)
+
             all_true, all_preds = self.evaluate(val_loaders, logger)
 
             self.train_time[task_id] = time.process_time() - start_time
             self.train_time_wall[task_id] = time.time() - start_time_wall
-        
+
+        executor.shutdown()
+
         self.test_confusion_matrix['true'] = all_true
         self.test_confusion_matrix['preds'] = all_preds
         self.test_confusion_matrix['labels'] = sorted(np.unique(all_true))
@@ -162,20 +187,50 @@ class Trainer:
 
         self.model.train()  # Set the model to training mode
 
+        # The logit width only changes between tasks, so resolve topk once
+        topk = (1, min(5, sum(self.model.num_classes_per_task)))
+        log_interval = 50
+
+        # Metrics accumulate on-device; every .item() is a device-to-host sync,
+        # so they are flushed to the logger only every log_interval batches
+        loss_sum = torch.zeros((), device=self.device)
+        acc1_sum = torch.zeros((), device=self.device)
+        acc5_sum = torch.zeros((), device=self.device)
+        window_batches, window_samples = 0, 0
+
         for batch_index, (x, y) in enumerate(data_loader):
             data_time.update(time.time() - end)
 
-            x = x.to(self.device)
-            y = y.type(torch.LongTensor).to(self.device)
-            output = self.model(x)
+            # Clearing gradients before the forward pass lets the allocator
+            # reuse the buffers; set_to_none skips writing zeros entirely.
+            self.optimiser.zero_grad(set_to_none=True)
+
+            x = x.to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
+
+            with torch.cuda.amp.autocast(enabled=self.device == 'cuda'):
+                output = self.forward_model(x)
+                loss = self.criterion(output, y)
 
-            loss = self.criterion(output, y)
-            acc1, acc5 = accuracy(output, y, topk=(1, min(5, output.shape[1])))
+            acc1, acc5 = accuracy(output, y, topk=topk)
 
             # Log Metrics
-            metric_logger.update(loss=loss.item())
-            metric_logger.meters['acc1'].update(acc1.item(), n=x.shape[0])
-            metric_logger.meters['acc5'].update(acc5.item(), n=x.shape[0])
+            loss_sum += loss.detach()
+            acc1_sum += acc1 * x.shape[0]
+            acc5_sum += acc5 * x.shape[0]
+            window_batches += 1
+            window_samples += x.shape[0]
+
+            if batch_index % log_interval == 0 or batch_index == len(data_loader) - 1:
+                metric_logger.update(loss=(loss_sum / window_batches).item())
+                metric_logger.meters['acc1'].update((acc1_sum / window_samples).item(),
+                                                    n=window_samples)
+                metric_logger.meters['acc5'].update((acc5_sum / window_samples).item(),
+                                                    n=window_samples)
+                loss_sum.zero_()
+                acc1_sum.zero_()
+                acc5_sum.zero_()
+                window_batches, window_samples = 0, 0
 
             iter_time.update(time.time() - end)
 
@@ -183,9 +238,9 @@ class Trainer:
             header = 'Task: [{}] Epoch: [{}]'.format(task_id, epoch)
             metric_logger.print_log(header, batch_index, len(data_loader), iter_time, data_time)
 
-            loss.backward()
-            self.optimiser.step()
-            self.optimiser.zero_grad()  # Zero gradients for the next batch
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimiser)
+            self.scaler.update()
 
         self.train_loss[task_id] = loss
         self.train_accuracy[task_id] = acc1
@@ -213,6 +268,8 @@ class Trainer:
         metric_logger = MetricLogger(delimiter="  ")
         self.model.eval()  # Set the model to evaluation mode
 
+        topk = (1, min(5, sum(self.model.num_classes_per_task)))
+
         all_preds, all_true = [], []
         for task_id, val_loader in enumerate(data_loader):
             start_time_wall = time.time()
@@ -220,46 +277,64 @@ class Trainer:
             iter_time = SmoothedValue(fmt='{avg:.4f}')
             data_time = SmoothedValue(fmt='{avg:.4f}')
 
-            ypreds, ytrue = [], []
+            header = 'Test:'
+
+            # Predictions, targets and metrics stay on-device for the whole
+            # task; per-batch .cpu()/.item() calls would each stall on a sync
+            preds_buf, tgts_buf = [], []
+            loss_sum = torch.zeros((), device=self.device)
+            acc1_sum = torch.zeros((), device=self.device)
+            acc5_sum = torch.zeros((), device=self.device)
+            num_batches, num_samples = 0, 0
 
             for batch_index, (x, y) in enumerate(val_loader):
                 data_time.update(time.time() - end)
 
-                x = x.to(self.device)
-                y = y.type(torch.LongTensor).to(self.device)
-                output = self.model(x)
+                x = x.to(self.device, non_blocking=True)
+                y = y.to(self.device, non_blocking=True)
 
-                loss = self.criterion(output, y)
-                acc1, acc5 = accuracy(output, y, topk=(1, min(5, output.shape[1])))
-
-                self.val_loss[task_id] = loss
-                self.val_accuracy[task_id] = acc1
-
-                # Log Metrics
-                metric_logger.update(loss=loss.item())
-                metric_logger.meters['acc1'].update(acc1.item(), n=x.shape[0])
-                metric_logger.meters['acc5'].update(acc5.item(), n=x.shape[0])
-
-                # Convert task_id to a tensor and expand its dimensions to match predictions and 
-                # targets. Assuming task_id is a scalar, use torch.full to create a tensor of the 
-                # same shape as predictions filled with the task_id value
-                predictions = output.detach().cpu().argmax(dim=1)
-                targets = y.detach().cpu()
-                task_ids = torch.full_like(predictions, task_id)
-                logger.add([predictions, targets, task_ids], subset='test')
-                ypreds.extend(predictions)
-                ytrue.extend(targets)
-                all_preds.extend(predictions)
-                all_true.extend(targets)
+                with torch.cuda.amp.autocast(enabled=self.device == 'cuda'):
+                    output = self.forward_model(x)
+                    loss = self.criterion(output, y)
+                acc1, acc5 = accuracy(output, y, topk=topk)
 
-                iter_time.update(time.time() - end)
+                loss_sum += loss
+                acc1_sum += acc1 * x.shape[0]
+                acc5_sum += acc5 * x.shape[0]
+                num_batches += 1
+                num_samples += x.shape[0]
 
-                # Print Metrics
-                header = 'Test:'
-                metric_logger.print_log(header, batch_index, len(data_loader), iter_time, data_time)
+                preds_buf.append(output.argmax(dim=1))
+                tgts_buf.append(y)
 
+                iter_time.update(time.time() - end)
                 end = time.time()
 
+            loss_avg = (loss_sum / num_batches).item()
+            acc1_avg = (acc1_sum / num_samples).item()
+            acc5_avg = (acc5_sum / num_samples).item()
+
+            self.val_loss[task_id] = loss_avg
+            self.val_accuracy[task_id] = acc1_avg
+
+            # Log Metrics
+            metric_logger.update(loss=loss_avg)
+            metric_logger.meters['acc1'].update(acc1_avg, n=num_samples)
+            metric_logger.meters['acc5'].update(acc5_avg, n=num_samples)
+
+            # One batched transfer per task instead of two per batch. task_id
+            # is a scalar, so torch.full_like expands it to the predictions'
+            # shape for the continuum logger.
+            predictions = torch.cat(preds_buf).cpu()
+            targets = torch.cat(tgts_buf).cpu()
+            task_ids = torch.full_like(predictions, task_id)
+            logger.add([predictions, targets, task_ids], subset='test')
+            all_preds.extend(predictions)
+            all_true.extend(targets)
+
+            # Print Metrics
+            metric_logger.print_log(header, 0, len(data_loader), iter_time, data_time)
+
             total_time = time.time() - start_time_wall
             total_time_str = str(datetime.timedelta(seconds=int(total_time)))
             print('{} Total time: {} ({:.4f} s / it)'.format(header, total_time_str, 